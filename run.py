@@ -2,27 +2,122 @@
 2023-07-23
 Script to compile and organize concerts for various performers.
 """
+import argparse
+import asyncio
+import hashlib
+import html
+import json
+import logging
 import re
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from operator import attrgetter
+from pathlib import Path
+import aiohttp
+import lxml.etree
+import lxml.html
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 from googlesearch import search
 from pywebio import start_server
 from pywebio.input import input, TEXT
 from pywebio.output import put_text, put_markdown, put_loading
 
+MAX_CONCURRENT_REQUESTS = 8
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=5)
+USER_AGENT = "ConcertCurator/1.0"
+CHUNK_SIZE = 8192
+LOCATION_ALIASES = {
+    "usa": "USA",
+    "us": "USA",
+    "u.s.": "USA",
+    "u.s.a.": "USA",
+    "united states": "USA",
+    "uk": "United Kingdom",
+    "u.k.": "United Kingdom",
+}
+LABEL_WEBSITE_TEMPLATES = (
+    "https://www.deutschegrammophon.com/en/artists/{slug}",
+    "https://www.deccaclassics.com/en/artists/{slug}",
+)
+POSTAL_ADDRESS_FIELDS = ("streetAddress", "addressLocality", "addressRegion", "postalCode")
+MARKDOWN_SPECIAL_CHARACTERS = re.compile(r"([\\`*_{}\[\]()#+\-.!|<>~])")
+CACHE_FILE = Path(__file__).with_name("concerts_cache.json")
+WEBSITE_CACHE_FILE = Path(__file__).with_name("websites_cache.json")
+CACHE_EXPIRE_AFTER = 3600
+VALIDATED_PAGE_TTL = 600
+JSON_LD_SCRIPTS = lxml.etree.XPath('//script[@type="application/ld+json"]/text()')
+
+
+def load_cache(path):
+    """
+    Load cache from disk
+    Returns empty cache if file is missing or unreadable
+    """
+    try:
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path, cache):
+    """
+    Save cache to disk
+    """
+    with _cache_lock:
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(cache, file)
+
+
+_SESSION = requests.Session()
+_SESSION.headers.update({"User-Agent": USER_AGENT})
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+logger = logging.getLogger(__name__)
+_cache_lock = threading.Lock()
+_search_lock = threading.Lock()
+_thread_local = threading.local()
+_page_cache = load_cache(CACHE_FILE)
+_website_cache = load_cache(WEBSITE_CACHE_FILE)
+_validated_pages = {}
+
+
+def clear_caches():
+    """
+    Forget all cached websites and concerts
+    """
+    with _cache_lock:
+        _page_cache.clear()
+        _website_cache.clear()
+
+
+@dataclass(frozen=True, slots=True)
+class Concert:
+    """
+    Upcoming concert for a performer
+    """
+
+    date: str
+    performer: str
+    piece: str
+    venue_name: str
+    address: str
+    ticket_site: str
+    image_url: str
+
 
 def correct_locations(locations):
     """
     Correct location capitalization and alternative country names.
     """
     for i, loc in enumerate(locations):
-        if loc != "USA":
-            if "d'" not in loc:
-                locations[i] = loc.title()
-            if locations[i] in ["Usa", "U.S.", "US", "U.S.A.", "United States"]:
-                locations[i] = "USA"
-            elif locations[i] in ["Uk", "UK", "U.K."]:
-                locations[i] = "United Kingdom"
+        locations[i] = LOCATION_ALIASES.get(
+            loc.lower(), loc if "d'" in loc else loc.title()
+        )
 
 
 def get_list_from_input(input_string):
@@ -32,14 +127,66 @@ def get_list_from_input(input_string):
     return [elt.strip() for elt in str(input_string).split(",")]
 
 
+def remember_validated_page(website, content):
+    """
+    Keep website content fetched during validation for the following run
+    Drops pages that were never used within VALIDATED_PAGE_TTL seconds
+    """
+    now = time.time()
+    with _cache_lock:
+        for stale in [
+            key
+            for key, (fetched_at, _) in _validated_pages.items()
+            if now - fetched_at > VALIDATED_PAGE_TTL
+        ]:
+            del _validated_pages[stale]
+        _validated_pages[website] = (now, content)
+
+
+def pop_validated_page(website):
+    """
+    Get website content fetched during validation, if still recent
+    Returns None otherwise
+    """
+    with _cache_lock:
+        fetched_at, content = _validated_pages.pop(website, (0, None))
+    if time.time() - fetched_at > VALIDATED_PAGE_TTL:
+        return None
+    return content
+
+
+def check_artist(name):
+    """
+    Check whether artist is on-tour
+    Returns name if artist not found on-tour, else None
+    """
+    website = get_website(name)
+    if website is None:
+        return name
+    try:
+        content = get_content(website)
+    except requests.RequestException:
+        return name
+    if not concerts_on_website(content):
+        return name
+    remember_validated_page(website, content)
+    return None
+
+
 def check_artists(input_names):
     """
     Validate artist names
     """
-    for name in get_list_from_input(input_names):
-        if not concerts_on_website(get_pretty_soup(get_website(querify_name(name)))):
-            return f"'{name}' was not found on-tour on \
-                https://www.deutschegrammophon.com or https://www.deccaclassics.com"
+    names = get_list_from_input(input_names)
+    with ThreadPoolExecutor(
+        max_workers=min(MAX_CONCURRENT_REQUESTS, len(names))
+    ) as executor:
+        missing = [name for name in executor.map(check_artist, names) if name]
+    if missing:
+        quoted_names = ", ".join(f"'{name}'" for name in missing)
+        verb = "was" if len(missing) == 1 else "were"
+        return f"{quoted_names} {verb} not found on-tour on \
+            https://www.deutschegrammophon.com or https://www.deccaclassics.com"
     return None
 
 
@@ -77,12 +224,12 @@ def sort_concerts(all_concerts, input_locations):
     """
     Sort concerts by date and location.
     """
-    all_concerts.sort(key=lambda concert: concert["date"])
+    all_concerts.sort(key=attrgetter("date"))
     if input_locations not in (["Any"], [""]):
         concerts_near_me = [
             concert
             for concert in all_concerts
-            if any(location in concert["address"] for location in input_locations)
+            if any(location in concert.address for location in input_locations)
         ]
     else:
         concerts_near_me = all_concerts
@@ -90,90 +237,358 @@ def sort_concerts(all_concerts, input_locations):
     return concerts_near_me
 
 
+def escape_markdown(string):
+    """
+    Backslash-escape markdown syntax so that text displays literally
+    """
+    return MARKDOWN_SPECIAL_CHARACTERS.sub(r"\\\1", string)
+
+
+def format_concert(concert):
+    """
+    Format concert as markdown
+    """
+    lines = [f"## **{concert.date}**", f"**{escape_markdown(concert.performer)}**"]
+    if concert.piece:
+        lines.append(f"*{escape_markdown(concert.piece)}*")
+    lines += [
+        escape_markdown(concert.venue_name),
+        escape_markdown(concert.address),
+        f"Tickets: {concert.ticket_site}",
+    ]
+    return "\n\n".join(lines)
+
+
 def print_output(concerts_near_me):
     """
     Print results
     """
     if not concerts_near_me:
         put_text("No matching concerts found.")
-    else:
-        put_markdown("# **Upcoming concerts**")
+        return
+
+    put_markdown(
+        "\n\n".join(
+            ["# **Upcoming concerts**", *map(format_concert, concerts_near_me)]
+        )
+    )
+
 
-    for concert in concerts_near_me:
-        put_markdown(f'## **{concert["date"]}**')
-        put_markdown(f'**{concert["performer"]}**')
-        if concert["piece"] != "</div>":
-            put_markdown(f'*{concert["piece"]}*')
-        put_text(concert["venue_name"])
-        put_text(concert["address"])
-        put_markdown(f'Tickets: {concert["ticket_site"]}')
-        put_text("\n")
+def slugify_name(name):
+    """
+    Turn name into record label URL slug, e.g., "Hélène Grimaud" -> "helene-grimaud"
+    """
+    ascii_name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    return "-".join(ascii_name.lower().split())
 
 
-def get_website(query):
+def guess_website(name):
     """
-    Get record label website that matches the query
+    Get record label website by trying the known artist URL patterns
+    Redirects are not followed, so an unknown slug sent to an index page is not a match
+    Returns None if no pattern matches
+    """
+    slug = slugify_name(name)
+    for template in LABEL_WEBSITE_TEMPLATES:
+        website = template.format(slug=slug)
+        try:
+            response = _SESSION.head(website, timeout=3, allow_redirects=False)
+        except requests.RequestException:
+            continue
+        if response.status_code == 200:
+            return website
+    return None
+
+
+def search_website(name):
+    """
+    Get record label website from Google search results
+    Searches run one at a time so that pause=2 still throttles requests to Google
     Returns None if matching website not found
     """
-    for search_result in search(query, tld="co.in", num=10, stop=10, pause=2):
-        if (
-            "deutschegrammophon.com" in search_result
-            or "deccaclassics.com" in search_result
+    with _search_lock:
+        for search_result in search(
+            querify_name(name), tld="co.in", num=10, stop=10, pause=2
         ):
-            website = search_result
-            return website
+            if (
+                "deutschegrammophon.com" in search_result
+                or "deccaclassics.com" in search_result
+            ):
+                return search_result
     return None
 
 
-def get_pretty_soup(website):
+def get_website(name):
     """
-    Get website content
+    Get record label website for performer
+    Returns None if matching website not found
     """
-    content = requests.get(website, timeout=5).text
-    pretty_soup = BeautifulSoup(content, "lxml").prettify()
-    return pretty_soup
+    website = _website_cache.get(name)
+    if website is not None:
+        return website
 
+    website = guess_website(name) or search_website(name)
+    if website is not None:
+        with _cache_lock:
+            _website_cache[name] = website
+        save_cache(WEBSITE_CACHE_FILE, _website_cache)
+    return website
 
-def concerts_on_website(pretty_soup):
+
+def get_content(website):
+    """
+    Get raw website content
+    """
+    response = _SESSION.get(website, timeout=5)
+    response.raise_for_status()
+    return response.content
+
+
+def concerts_on_website(content):
     """
     Check whether website displays upcoming concerts
     """
-    if "Tour Dates" not in pretty_soup:
+    if b"Tour Dates" not in content:
         return False
     return True
 
 
-def update_for_artist(all_concerts, query):
+def between(string, start, end, pos=0):
+    """
+    Get substring between the first start marker at or after pos and the next end marker
+    Works on str or bytes
+    Returns substring and index of end marker, or empty substring and -1 if not found
+    """
+    i = string.find(start, pos)
+    if i == -1:
+        return string[:0], -1
+    i += len(start)
+    j = string.find(end, i)
+    if j == -1:
+        return string[:0], -1
+    return string[i:j], j
+
+
+def find_music_events(data):
+    """
+    Recursively collect MusicEvent entries from parsed JSON-LD
+    """
+    if isinstance(data, list):
+        return [event for item in data for event in find_music_events(item)]
+    if not isinstance(data, dict):
+        return []
+    if data.get("@type") == "MusicEvent":
+        return [data]
+    return [event for value in data.values() for event in find_music_events(value)]
+
+
+def get_html_parser():
+    """
+    Get this thread's UTF-8 HTML parser
+    lxml parsers lock while parsing, so each worker thread keeps its own
+    """
+    if not hasattr(_thread_local, "html_parser"):
+        _thread_local.html_parser = lxml.html.HTMLParser(encoding="utf-8")
+    return _thread_local.html_parser
+
+
+def get_events(content):
+    """
+    Get MusicEvent entries from website's JSON-LD script blocks
+    """
+    events = []
+    tree = lxml.html.fromstring(content, parser=get_html_parser())
+    for script in JSON_LD_SCRIPTS(tree):
+        try:
+            events.extend(find_music_events(json.loads(script)))
+        except ValueError:
+            continue
+    return events
+
+
+def first(value):
+    """
+    Get first item of a JSON-LD value, which may or may not be a list
+    """
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+
+def text(value):
+    """
+    Get JSON-LD value as text
+    Returns empty string if value is not a string
+    """
+    return value if isinstance(value, str) else ""
+
+
+def as_dict(value):
+    """
+    Get JSON-LD value as dict
+    Returns empty dict if value is not a dict
+    """
+    return value if isinstance(value, dict) else {}
+
+
+def format_address(address):
+    """
+    Get JSON-LD address, which may be text or a PostalAddress, as text
+    """
+    if not isinstance(address, dict):
+        return text(address)
+    country = address.get("addressCountry")
+    if isinstance(country, dict):
+        country = country.get("name")
+    parts = [text(address.get(field)) for field in POSTAL_ADDRESS_FIELDS]
+    parts.append(text(country))
+    return ", ".join(part for part in parts if part)
+
+
+def extract_concerts(content):
+    """
+    Extract list of concerts from performer's raw website content
+    Returns empty list if website displays no upcoming concerts
+    """
+    if not concerts_on_website(content):
+        return []
+
+    performer, _ = between(content, b"Tour Dates - ", b" in Concert")
+    performer = html.unescape(performer.decode("utf-8", "replace"))
+    events = [event for event in get_events(content) if text(event.get("startDate"))]
+    concerts = [None] * len(events)
+    for i, event in enumerate(events):
+        location = first(event.get("location"))
+        if isinstance(location, str):
+            location = {"name": location}
+        location = as_dict(location)
+        image = first(event.get("image"))
+        if isinstance(image, dict):
+            image = image.get("url")
+        concerts[i] = Concert(
+            date=event["startDate"][:10],
+            performer=performer,
+            piece=text(event.get("description")),
+            venue_name=text(location.get("name")),
+            address=format_address(location.get("address")),
+            ticket_site=text(as_dict(first(event.get("offers"))).get("url")),
+            image_url=text(image),
+        )
+    return concerts
+
+
+def find_events_end(buffer, pos=0):
+    """
+    Find end of the first JSON-LD script block listing events, searching from pos
+    Returns -1 if no complete block is found
+    """
+    end = buffer.find(b"</script>", pos)
+    while end != -1:
+        block = buffer[buffer.rfind(b"<script", 0, end) : end]
+        if b"application/ld+json" in block and b"MusicEvent" in block:
+            return end + len(b"</script>")
+        end = buffer.find(b"</script>", end + 1)
+    return -1
+
+
+async def read_until_events(response):
+    """
+    Read raw website content until both the JSON-LD block listing its events
+    and the "Tour Dates - ... in Concert" performer heading have been received
+    Reads the whole website if either is missing
+    """
+    buffer = bytearray()
+    events_end = -1
+    performer_start = performer_end = -1
+    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+        scan_from = max(0, len(buffer) - len(b"Tour Dates - "))
+        buffer += chunk
+        if events_end == -1:
+            events_end = find_events_end(buffer, scan_from)
+        if performer_start == -1:
+            performer_start = buffer.find(b"Tour Dates - ", scan_from)
+        if performer_start != -1 and performer_end == -1:
+            performer_end = buffer.find(b" in Concert", performer_start)
+        if events_end != -1 and performer_end != -1:
+            # Cut at a fixed point so the checksum does not depend on chunking
+            cut = max(events_end, performer_end + len(b" in Concert"))
+            return bytes(buffer[:cut])
+    return bytes(buffer)
+
+
+def cached_concerts(entry):
+    """
+    Get concerts stored in a cached page entry
+    """
+    return [Concert(**concert) for concert in entry["concerts"]]
+
+
+def conditional_headers(entry):
+    """
+    Get revalidation headers for a cached page
+    """
+    headers = {}
+    if entry is None:
+        return headers
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+async def update_for_artist(session, semaphore, all_concerts, name):
     """
     Update unsorted list of concerts for individual performer
+    Reuses cached concerts while fresh, or when the website is unchanged,
+    and reuses website content already fetched during validation
     """
-    website = get_website(query)
-    pretty_soup = get_pretty_soup(website)
-    if not concerts_on_website(pretty_soup):
+    website = await asyncio.to_thread(get_website, name)
+    if website is None:
+        return
+
+    content = pop_validated_page(website)
+    validated = content is not None
+    entry = _page_cache.get(website)
+    if entry is not None and time.time() - entry["fetched_at"] < CACHE_EXPIRE_AFTER:
+        all_concerts.extend(cached_concerts(entry))
         return
 
-    events = pretty_soup.split("MusicEvent")[1:]
-    events[-1] = events[-1].split('"performer":')[0]
-
-    for event in events:
-        concert = {}
-        performer = pretty_soup.split("Tour Dates - ")[1].split(" in Concert")[0]
-        date = re.split("T..:..:..", event.split('"startDate":"')[1])[0]
-        venue_name = event.split('"@type":"Place","name":"')[1].split('","address":')[0]
-        piece = pretty_soup.split(venue_name)[-1].split("\n")[4].strip()
-        address = event.split('"address":"')[1].split('"},"offers":')[0]
-        ticket_site = event.split('"@type":"Offer","url":"')[1].split(
-            '","availability":"'
-        )[0]
-        image_url = event.split('"ImageObject","url":"')[1].split('","headline":"')[0]
-        concert["performer"] = performer
-        concert["date"] = date
-        concert["piece"] = piece
-        concert["venue_name"] = venue_name
-        concert["address"] = address
-        concert["ticket_site"] = ticket_site
-        concert["image_url"] = image_url
-        all_concerts.append(concert)
+    not_modified = False
+    etag = last_modified = None
+    if content is None:
+        async with semaphore:
+            async with session.get(
+                website, headers=conditional_headers(entry), timeout=REQUEST_TIMEOUT
+            ) as response:
+                not_modified = response.status == 304 and entry is not None
+                if not not_modified:
+                    response.raise_for_status()
+                    content = await read_until_events(response)
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+
+    if not_modified:
+        checksum = entry["checksum"]
+        concerts = cached_concerts(entry)
+    else:
+        # Validated pages are read in full rather than cut like streamed ones,
+        # so their checksum would never match and is not stored
+        checksum = None if validated else hashlib.sha1(content).hexdigest()
+        if checksum and entry is not None and entry["checksum"] == checksum:
+            concerts = cached_concerts(entry)
+        else:
+            concerts = await asyncio.to_thread(extract_concerts, content)
+
+    with _cache_lock:
+        _page_cache[website] = {
+            "etag": etag or (entry and entry.get("etag")),
+            "last_modified": last_modified or (entry and entry.get("last_modified")),
+            "checksum": checksum,
+            "fetched_at": time.time(),
+            "concerts": [asdict(concert) for concert in concerts],
+        }
+    all_concerts.extend(concerts)
 
 
 def querify_name(name):
@@ -183,6 +598,38 @@ def querify_name(name):
     return f"{name} concerts"
 
 
+async def fetch_all_concerts(artist_names):
+    """
+    Fetch concerts for all performers concurrently.
+    Returns unsorted list of concerts and list of performers whose concerts
+    could not be fetched.
+    """
+    all_concerts = []
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+    )
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    connector = aiohttp.TCPConnector(limit=20, keepalive_timeout=30)
+    async with aiohttp.ClientSession(
+        connector=connector, headers={"User-Agent": USER_AGENT}
+    ) as session:
+        results = await asyncio.gather(
+            *[
+                update_for_artist(session, semaphore, all_concerts, name)
+                for name in artist_names
+            ],
+            return_exceptions=True,
+        )
+    save_cache(CACHE_FILE, _page_cache)
+
+    failed_names = []
+    for name, result in zip(artist_names, results):
+        if isinstance(result, BaseException):
+            logger.error("Could not fetch concerts for %r", name, exc_info=result)
+            failed_names.append(name)
+    return all_concerts, failed_names
+
+
 def get_all_concerts():
     """
     Get unsorted list of all concerts, regardless of location.
@@ -190,11 +637,12 @@ def get_all_concerts():
     """
     artist_names, input_locations = get_inputs()
     with put_loading():
-        queries = [querify_name(name) for name in artist_names]
-        all_concerts = []
-
-        for query in queries:
-            update_for_artist(all_concerts, query)
+        all_concerts, failed_names = asyncio.run(fetch_all_concerts(artist_names))
+        if failed_names:
+            put_text(
+                f"Could not fetch concerts for {', '.join(failed_names)}. "
+                "Please try again later."
+            )
 
         return all_concerts, input_locations
 
@@ -211,4 +659,12 @@ def get_concerts():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="ignore cached performer websites and concerts",
+    )
+    if parser.parse_args().refresh:
+        clear_caches()
     start_server(get_concerts, port=80)
@@ -0,0 +1,269 @@
+"""
+Tests for page streaming, caching and JSON-LD extraction in run.py
+"""
+import asyncio
+import hashlib
+import json
+import time
+from dataclasses import asdict
+
+import aiohttp
+import pytest
+
+import run
+
+WEBSITE = "https://www.deutschegrammophon.com/en/artists/some-artist"
+
+EVENTS = [
+    {
+        "@type": "MusicEvent",
+        "startDate": "2026-11-02T19:30:00",
+        "description": "Chopin Ballades",
+        "location": {
+            "@type": "Place",
+            "name": "Salle Gaveau",
+            "address": "45 Rue La Boétie, Paris, France",
+        },
+        "offers": {"@type": "Offer", "url": "https://tickets.example/gaveau"},
+        "image": {"@type": "ImageObject", "url": "https://images.example/1.jpg"},
+    },
+    {"@type": "MusicEvent", "location": "No date given"},
+    {
+        "@type": "MusicEvent",
+        "startDate": "2026-10-20T20:00:00",
+        "location": "Carnegie Hall",
+        "offers": [{"@type": "Offer", "url": "https://tickets.example/carnegie"}],
+        "image": "https://images.example/2.jpg",
+    },
+    {
+        "@type": "MusicEvent",
+        "startDate": "2026-12-01",
+        "location": {
+            "name": "Wigmore Hall",
+            "address": {
+                "@type": "PostalAddress",
+                "streetAddress": "36 Wigmore Street",
+                "addressLocality": "London",
+                "addressCountry": {"name": "United Kingdom"},
+            },
+        },
+    },
+]
+
+
+def json_ld(data):
+    """
+    Wrap data in a JSON-LD script block
+    """
+    return (
+        b'<script type="application/ld+json">'
+        + json.dumps(data).encode()
+        + b"</script>"
+    )
+
+
+HEADING = "<h1>Tour Dates - Anne &amp; Friends in Concert</h1>".encode()
+EVENTS_BLOCK = json_ld({"@graph": EVENTS})
+PAGE = (
+    b"<html><head>"
+    + json_ld({"@type": "Organization", "name": "Label"})
+    + EVENTS_BLOCK
+    + b"</head><body>"
+    + b"x" * 5000
+    + HEADING
+    + b"y" * 20000
+    + b"</body></html>"
+)
+PAGE_CUT = PAGE[: PAGE.index(b" in Concert") + len(b" in Concert")]
+
+
+class FakeContent:
+    """
+    Stand-in for aiohttp's StreamReader yielding fixed-size chunks
+    """
+
+    def __init__(self, body, chunk_size):
+        self.body = body
+        self.chunk_size = chunk_size
+
+    async def iter_chunked(self, _):
+        for i in range(0, len(self.body), self.chunk_size):
+            yield self.body[i : i + self.chunk_size]
+
+
+class FakeResponse:
+    """
+    Stand-in for aiohttp's ClientResponse
+    """
+
+    def __init__(self, body=b"", status=200, headers=None, chunk_size=8192):
+        self.status = status
+        self.headers = headers or {}
+        self.content = FakeContent(body, chunk_size)
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(None, (), status=self.status)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeSession:
+    """
+    Stand-in for aiohttp's ClientSession returning a canned response
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.request_headers = []
+
+    def get(self, website, headers=None, timeout=None):
+        self.request_headers.append(headers)
+        return self.response
+
+
+@pytest.fixture(autouse=True)
+def isolated_caches(monkeypatch):
+    monkeypatch.setattr(run, "_page_cache", {})
+    monkeypatch.setattr(run, "_validated_pages", {})
+    monkeypatch.setattr(run, "get_website", lambda name: WEBSITE)
+
+
+def read(body, chunk_size):
+    return asyncio.run(run.read_until_events(FakeResponse(body, chunk_size=chunk_size)))
+
+
+def update(session):
+    async def update_concerts():
+        all_concerts = []
+        await run.update_for_artist(session, asyncio.Semaphore(1), all_concerts, "Anne")
+        return all_concerts
+
+    return asyncio.run(update_concerts())
+
+
+def cache_entry(checksum="old", fetched_at=0.0, etag='"v1"'):
+    concert = run.Concert("2026-01-01", "Anne", "", "Hall", "Paris", "", "")
+    return {
+        "etag": etag,
+        "last_modified": None,
+        "checksum": checksum,
+        "fetched_at": fetched_at,
+        "concerts": [asdict(concert)],
+    }
+
+
+def test_find_events_end_skips_json_ld_without_events():
+    assert run.find_events_end(PAGE) == PAGE.index(EVENTS_BLOCK) + len(EVENTS_BLOCK)
+
+
+def test_find_events_end_needs_complete_block():
+    assert run.find_events_end(PAGE[: PAGE.index(EVENTS_BLOCK) + 50]) == -1
+    assert run.find_events_end(b"<html><body>No events</body></html>") == -1
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 13, 64, 1000, 8192, len(PAGE)])
+def test_read_until_events_cut_does_not_depend_on_chunking(chunk_size):
+    assert read(PAGE, chunk_size) == PAGE_CUT
+
+
+def test_read_until_events_stops_after_events_when_heading_comes_first():
+    page = b"<html><head><title>Tour Dates - Anne in Concert</title>"
+    page += EVENTS_BLOCK + b"</head><body>" + b"z" * 10000 + b"</body></html>"
+    assert read(page, 100) == page[: page.index(EVENTS_BLOCK) + len(EVENTS_BLOCK)]
+
+
+@pytest.mark.parametrize(
+    "page",
+    [PAGE.replace(b"Tour Dates - ", b"Concerts - "), PAGE.replace(b"MusicEvent", b"Event")],
+)
+def test_read_until_events_reads_whole_page_when_marker_missing(page):
+    assert read(page, 100) == page
+
+
+def test_extract_concerts_reads_json_ld_fields():
+    concerts = run.extract_concerts(PAGE)
+    assert [concert.date for concert in concerts] == [
+        "2026-11-02",
+        "2026-10-20",
+        "2026-12-01",
+    ]
+    assert {concert.performer for concert in concerts} == {"Anne & Friends"}
+    assert concerts[0] == run.Concert(
+        date="2026-11-02",
+        performer="Anne & Friends",
+        piece="Chopin Ballades",
+        venue_name="Salle Gaveau",
+        address="45 Rue La Boétie, Paris, France",
+        ticket_site="https://tickets.example/gaveau",
+        image_url="https://images.example/1.jpg",
+    )
+
+
+def test_extract_concerts_tolerates_alternative_field_shapes():
+    _, carnegie, wigmore = run.extract_concerts(PAGE)
+    assert carnegie.venue_name == "Carnegie Hall"
+    assert carnegie.address == ""
+    assert carnegie.ticket_site == "https://tickets.example/carnegie"
+    assert carnegie.image_url == "https://images.example/2.jpg"
+    assert wigmore.address == "36 Wigmore Street, London, United Kingdom"
+    assert wigmore.ticket_site == ""
+    assert wigmore.piece == ""
+
+
+def test_extract_concerts_without_tour_dates():
+    assert run.extract_concerts(PAGE.replace(b"Tour Dates", b"Recordings")) == []
+
+
+def test_fresh_cache_entry_skips_request():
+    run._page_cache[WEBSITE] = cache_entry(fetched_at=time.time())
+    session = FakeSession(FakeResponse(PAGE))
+    assert [concert.venue_name for concert in update(session)] == ["Hall"]
+    assert not session.request_headers
+
+
+def test_not_modified_reuses_cached_concerts():
+    run._page_cache[WEBSITE] = cache_entry()
+    session = FakeSession(FakeResponse(status=304))
+    assert [concert.venue_name for concert in update(session)] == ["Hall"]
+    assert session.request_headers == [{"If-None-Match": '"v1"'}]
+    assert run._page_cache[WEBSITE]["checksum"] == "old"
+    assert run._page_cache[WEBSITE]["fetched_at"] > 0
+
+
+def test_unchanged_checksum_skips_parsing(monkeypatch):
+    checksum = hashlib.sha1(PAGE_CUT).hexdigest()
+    run._page_cache[WEBSITE] = cache_entry(checksum=checksum)
+    monkeypatch.setattr(run, "extract_concerts", pytest.fail)
+    concerts = update(FakeSession(FakeResponse(PAGE, chunk_size=512)))
+    assert [concert.venue_name for concert in concerts] == ["Hall"]
+
+
+def test_changed_page_is_parsed_and_cached():
+    run._page_cache[WEBSITE] = cache_entry()
+    concerts = update(FakeSession(FakeResponse(PAGE, headers={"ETag": '"v2"'})))
+    assert len(concerts) == 3
+    entry = run._page_cache[WEBSITE]
+    assert entry["etag"] == '"v2"'
+    assert entry["checksum"] == hashlib.sha1(PAGE_CUT).hexdigest()
+    assert len(entry["concerts"]) == 3
+
+
+@pytest.mark.parametrize("status", [403, 404, 503])
+def test_error_status_is_not_cached(status):
+    old_entry = cache_entry()
+    run._page_cache[WEBSITE] = old_entry
+    session = FakeSession(FakeResponse(b"Error", status=status, headers={"ETag": "e1"}))
+    with pytest.raises(aiohttp.ClientResponseError):
+        update(session)
+    assert run._page_cache[WEBSITE] is old_entry
+
+
+def test_error_status_without_cache_entry_is_not_cached():
+    with pytest.raises(aiohttp.ClientResponseError):
+        update(FakeSession(FakeResponse(status=503)))
+    assert WEBSITE not in run._page_cache